@@ -0,0 +1,222 @@
+import threading
+from array import array
+
+class IdTable(object):
+    """Set of 64-bit integers in an open-addressing hash table.
+
+    Ids are kept unboxed in a single array('q') with linear probing, which
+    costs 8 bytes per slot. The table is rebuilt to be at most half full, so
+    an id takes about 16 to 24 bytes, compared to about 70 for a Python set
+    of ints.
+    """
+    _EMPTY = -2**63
+    _DELETED = -2**63 + 1
+    _MIN_BITS = 4
+
+    def __init__(self):
+        self._rebuild(self._MIN_BITS, ())
+
+    def _rebuild(self, bits, ids):
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._slots = array('q', [self._EMPTY]) * (1 << bits)
+        self._size = 0
+        # Live plus deleted slots, a probe only stops at an empty slot.
+        self._used = 0
+        for match_id in ids:
+            self._insert(match_id)
+
+    def _index(self, match_id):
+        # Fibonacci hashing, spreads sequential match ids over the table.
+        return ((match_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._bits)
+
+    def _find(self, match_id):
+        """Return the slot holding match_id, or -1."""
+        i = self._index(match_id)
+        while True:
+            slot = self._slots[i]
+            if slot == match_id:
+                return i
+            if slot == self._EMPTY:
+                return -1
+            i = (i + 1) & self._mask
+
+    def _insert(self, match_id):
+        i = self._index(match_id)
+        while True:
+            slot = self._slots[i]
+            if slot == self._EMPTY or slot == self._DELETED:
+                break
+            i = (i + 1) & self._mask
+        if self._slots[i] == self._EMPTY:
+            self._used += 1
+        self._slots[i] = match_id
+        self._size += 1
+
+    def _resize(self):
+        # Smallest power of two that leaves the table at most half full.
+        bits = self._MIN_BITS
+        while (1 << bits) < 2*self._size:
+            bits += 1
+        self._rebuild(bits, list(self))
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, match_id):
+        return self._find(match_id) >= 0
+
+    def __iter__(self):
+        for slot in self._slots:
+            if slot != self._EMPTY and slot != self._DELETED:
+                yield slot
+
+    def add(self, match_id):
+        """Add match_id, returns False if it was already present."""
+        if self._find(match_id) >= 0:
+            return False
+        self._insert(match_id)
+        # Rebuild at two thirds full, counting deleted slots, to keep probes short.
+        if 3*self._used > 2*len(self._slots):
+            self._resize()
+        return True
+
+    def discard(self, match_id):
+        i = self._find(match_id)
+        if i < 0:
+            return
+        self._slots[i] = self._DELETED
+        self._size -= 1
+        # Give memory back once the backlog drains.
+        if self._bits > self._MIN_BITS and 8*self._size < len(self._slots):
+            self._resize()
+
+    def nbytes(self):
+        return self._slots.itemsize * len(self._slots)
+
+class MatchBacklog(object):
+    """FIFO of match ids waiting to be fetched.
+
+    Match ids are stored as packed 64-bit integers in an array backed ring
+    buffer. An IdTable of queued ids rejects ids that are already queued,
+    and ids handed out by get_batch stay in an in-flight IdTable until they
+    are either done or put back, so they are rejected for their whole
+    lifetime. Together that is about 24 to 40 bytes per queued id.
+    """
+    _INITIAL_CAPACITY = 1024
+    _MAX_FAILS = 5
+
+    def __init__(self, match_ids=()):
+        self._buf = array('q', bytes(8*self._INITIAL_CAPACITY))
+        self._head = 0
+        self._size = 0
+        self._members = IdTable()
+        self._in_flight = IdTable()
+        # Only ids that failed, so this stays small.
+        self._fail_counts = {}
+        self._lock = threading.Lock()
+        self.put(match_ids)
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def __contains__(self, match_id):
+        match_id = int(match_id)
+        with self._lock:
+            return match_id in self._members or match_id in self._in_flight
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def nbytes(self):
+        """Bytes held by the ring buffer and the id tables."""
+        with self._lock:
+            return self._buf.itemsize*len(self._buf) + self._members.nbytes() + self._in_flight.nbytes()
+
+    def _grow(self):
+        # Unroll the ring into a buffer of twice the size.
+        capacity = len(self._buf)
+        buf = array('q', bytes(16*capacity))
+        for i in range(self._size):
+            buf[i] = self._buf[(self._head+i) % capacity]
+        self._buf = buf
+        self._head = 0
+
+    def _enqueue(self, match_id):
+        if self._size == len(self._buf):
+            self._grow()
+        tail = (self._head+self._size) % len(self._buf)
+        self._buf[tail] = match_id
+        self._size += 1
+        self._members.add(match_id)
+
+    def put(self, match_ids):
+        """Enqueue match ids, returns the number of ids actually added."""
+        added = 0
+        with self._lock:
+            for match_id in match_ids:
+                match_id = int(match_id)
+                if match_id in self._members or match_id in self._in_flight:
+                    continue
+                self._enqueue(match_id)
+                added += 1
+        return added
+
+    def put_back(self, match_ids, failed=False):
+        """Re-enqueue in-flight match ids that could not be finished.
+
+        If failed, the ids are charged a failure and those that failed
+        _MAX_FAILS times are dropped instead. Returns the dropped ids.
+        """
+        dropped = []
+        with self._lock:
+            for match_id in match_ids:
+                match_id = int(match_id)
+                self._in_flight.discard(match_id)
+                if failed:
+                    fails = self._fail_counts.get(match_id, 0) + 1
+                    if fails >= self._MAX_FAILS:
+                        self._fail_counts.pop(match_id)
+                        dropped.append(str(match_id))
+                        continue
+                    self._fail_counts[match_id] = fails
+                if match_id not in self._members:
+                    self._enqueue(match_id)
+        return dropped
+
+    def done(self, match_ids):
+        """Forget in-flight match ids, once inserted or dropped."""
+        with self._lock:
+            for match_id in match_ids:
+                self._in_flight.discard(int(match_id))
+                self._fail_counts.pop(int(match_id), None)
+
+    def get_batch(self, n):
+        """Dequeue at most n match ids, as strings ready for the API."""
+        batch = []
+        with self._lock:
+            capacity = len(self._buf)
+            while self._size > 0 and len(batch) < n:
+                match_id = self._buf[self._head]
+                self._head = (self._head+1) % capacity
+                self._size -= 1
+                self._members.discard(match_id)
+                self._in_flight.add(match_id)
+                batch.append(str(match_id))
+        return batch
+
+    def _ordered(self):
+        capacity = len(self._buf)
+        return array('q', (self._buf[(self._head+i) % capacity] for i in range(self._size)))
+
+    def __getstate__(self):
+        # In-flight ids are saved as queued, so a crash never loses them.
+        with self._lock:
+            match_ids = self._ordered()
+            match_ids.extend(self._in_flight)
+            return {'match_ids': match_ids}
+
+    def __setstate__(self, state):
+        self.__init__(state['match_ids'])
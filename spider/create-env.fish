@@ -4,3 +4,5 @@ echo 'set -gx POSTGRES_USERNAME docker;'
 echo 'set -gx POSTGRES_PASSWORD docker;'
 echo 'set -gx POSTGRES_DATABASE docker;'
 echo 'set -gx POSTGRES_HOSTNAME 192.168.99.101;'
+# Parallel database writers, the core count of the database host.
+echo 'set -gx POSTGRES_WRITERS 4;'
@@ -0,0 +1,237 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import profiling
+import retry
+from paladins import MatchDetails
+
+MATCH_DETAILS_COLUMNS = (
+    "account_level", "assists", "champion", "damage_dealt", "damage_taken",
+    "deaths", "credits", "match_date", "self_healing", "healing", "shielding",
+    "loadout_card1", "loadout_card2", "loadout_card3", "loadout_card4",
+    "loadout_card5", "loadout_card1_level", "loadout_card2_level",
+    "loadout_card3_level", "loadout_card4_level", "loadout_card5_level",
+    "item1", "item2", "item3", "item4", "item1_level", "item2_level",
+    "item3_level", "item4_level", "talent", "streak", "kills", "map",
+    "match_id", "match_duration", "highest_multi_kill", "objective_time",
+    "party_id", "platform", "region", "team1_score", "team2_score", "team",
+    "win_status", "player_id", "player_name", "master_level",
+)
+
+# Server-side prepared statements, created once on every new connection.
+_PREPARED_STATEMENTS = (
+    "PREPARE insert_match_details AS INSERT INTO match_details ({}) VALUES ({}) on conflict (match_id, player_name) do nothing".format(
+        ",".join(MATCH_DETAILS_COLUMNS),
+        ",".join(f"${i+1}" for i in range(len(MATCH_DETAILS_COLUMNS)))),
+    "PREPARE fetched_match_ids AS SELECT DISTINCT match_id FROM match_details WHERE match_id = ANY($1)",
+)
+
+_INSERT_MATCH_DETAILS = "EXECUTE insert_match_details ({})".format(
+    ",".join(["%s"]*len(MATCH_DETAILS_COLUMNS)))
+_FETCHED_MATCH_IDS = "EXECUTE fetched_match_ids (%s)"
+
+def dsn_from_env():
+    postgres_username = os.getenv("POSTGRES_USERNAME")
+    postgres_password = os.getenv("POSTGRES_PASSWORD")
+    postgres_database = os.getenv("POSTGRES_DATABASE")
+    postgres_hostname = os.getenv("POSTGRES_HOSTNAME")
+    return f"dbname={postgres_database} user={postgres_username} password={postgres_password} host={postgres_hostname}"
+
+class ConnectionPool(object):
+    """Thread-safe pool of at most `size` lazily opened connections.
+
+    Connections are only opened when needed, so the pool can be created
+    while Postgres is down, and broken connections are simply discarded.
+    """
+    def __init__(self, dsn, size):
+        self.dsn = dsn
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        cur = conn.cursor()
+        for statement in _PREPARED_STATEMENTS:
+            cur.execute(statement)
+        conn.commit()
+        cur.close()
+        return conn
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        if close or conn.closed:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.debug(e)
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+class Database(object):
+    # Retry a lost connection nine times before giving up, sleeping up to
+    # five minutes in total and about two and a half on average with full
+    # jitter, long enough to ride out a Postgres restart.
+    _MAX_ATTEMPTS = 10
+    _BACKOFF = retry.Backoff(base=1, cap=60)
+
+    def __init__(self, dsn, pool_size):
+        self.pool = ConnectionPool(dsn, pool_size)
+
+    def close(self):
+        self.pool.close()
+
+    def run(self, fn):
+        """Run fn(cursor) in a transaction, reconnecting if the connection is lost."""
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                conn = self.pool.getconn()
+                cur = conn.cursor()
+                result = fn(cur)
+                conn.commit()
+                cur.close()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if conn is not None:
+                    self.pool.putconn(conn, close=True)
+                attempt += 1
+                if attempt >= self._MAX_ATTEMPTS:
+                    raise
+                delay = self._BACKOFF.delay(attempt)
+                logging.warning(f"Lost database connection ({e}), reconnecting in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except Exception:
+                if conn is not None:
+                    close = False
+                    try:
+                        conn.rollback()
+                    except Exception as e:
+                        logging.debug(e)
+                        close = True
+                    finally:
+                        # Always hand the slot back, or the pool shrinks for good.
+                        self.pool.putconn(conn, close=close)
+                raise
+            self.pool.putconn(conn)
+            return result
+
+    def insert_match_details(self, matches):
+        rows = [MatchDetails(match_obj).as_tuple() for match_obj in matches]
+        # Inserts are idempotent, so replaying them after a reconnect is safe.
+        self.run(lambda cur: psycopg2.extras.execute_batch(cur, _INSERT_MATCH_DETAILS, rows))
+
+    def fetched_match_ids(self, match_ids):
+        """Return the subset of match_ids already in match_details."""
+        def query(cur):
+            cur.execute(_FETCHED_MATCH_IDS, ([int(match_id) for match_id in match_ids],))
+            return {str(row[0]) for row in cur.fetchall()}
+        return self.run(query)
+
+class Writers(object):
+    """Parallel workers inserting match details through a shared Database."""
+    def __init__(self, db, count):
+        self.db = db
+        self.count = count
+        # Bounded, so fetchers are slowed down when the database falls behind.
+        self.jobs = queue.Queue(maxsize=4*count)
+        self._rows_lock = threading.Lock()
+        self.rows = 0
+
+    def start(self):
+        for i in range(self.count):
+            threading.Thread(
+                name=f'db_writer_{i}',
+                target=self._work,
+                daemon=True).start()
+
+    def submit(self, matches, on_done=None, on_error=None):
+        """Queue match details for insertion.
+
+        on_done() is called once they are inserted, or dropped because they
+        can never be inserted. on_error(e) is called instead if the database
+        connection was lost, and the matches are worth fetching again.
+        """
+        self.jobs.put((matches, on_done, on_error))
+
+    def join(self, timeout=None):
+        """Block until all submitted inserts have finished.
+
+        Returns False if they did not finish within timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.jobs.all_tasks_done:
+            while self.jobs.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.jobs.all_tasks_done.wait(remaining)
+        return True
+
+    def cancel_pending(self, reason):
+        """Hand back inserts no writer has started on, through their on_error."""
+        while True:
+            try:
+                matches, on_done, on_error = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if on_error is not None:
+                    on_error(reason)
+            finally:
+                self.jobs.task_done()
+
+    def _work(self):
+        logging.info("Starting db_writer")
+        while True:
+            job = self.jobs.get()
+            try:
+                self._insert(*job)
+            finally:
+                self.jobs.task_done()
+
+    def _insert(self, matches, on_done, on_error):
+        try:
+            with profiling.stage("db.insert_matches"):
+                self.db.insert_match_details(matches)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logging.error(f"Lost database connection: {e}")
+            if on_error is not None:
+                on_error(e)
+            return
+        except Exception as e:
+            # Bad data, e.g. missing keys or values that do not fit the
+            # schema, fails the same way every time.
+            logging.error(f"Dropping {len(matches)} match details: {e}")
+        else:
+            with self._rows_lock:
+                self.rows += len(matches)
+        if on_done is not None:
+            on_done()
@@ -0,0 +1,88 @@
+import threading
+
+# Only used while the ledger is empty, when every interval ties and they are
+# fetched chronologically.
+_PRIOR_YIELD = 0.0
+
+def _slot(key):
+    # "-1" for full days, "HH,MM" for ten minute intervals.
+    return key[8:]
+
+def _kind(key):
+    return "day" if _slot(key) == "-1" else "minutes"
+
+class LedgerEntry(object):
+    def __init__(self, returned, new, requests):
+        self.returned = returned
+        self.new = new
+        self.requests = requests
+
+    def __str__(self):
+        return f"returned: {self.returned}, new: {self.new}, requests: {self.requests}"
+
+class YieldLedger(object):
+    """Persisted record of what every fetched interval produced.
+
+    Per interval key we keep how many match ids it returned, how many of
+    those were new and how many requests they cost. Totals are also kept per
+    time slot and per interval kind, to estimate the yield of intervals that
+    have not been fetched yet.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+        self._totals = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self.entries)
+
+    def _add_totals(self, key, entry, sign):
+        for group in (_slot(key), _kind(key), None):
+            new, requests = self._totals.get(group, (0, 0))
+            self._totals[group] = (new + sign*entry.new, requests + sign*entry.requests)
+
+    def record(self, key, returned, new, requests):
+        entry = LedgerEntry(returned, new, requests)
+        with self._lock:
+            if key in self.entries:
+                self._add_totals(key, self.entries[key], -1)
+            self.entries[key] = entry
+            self._add_totals(key, entry, 1)
+
+    def remove(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self._add_totals(key, entry, -1)
+
+    def keys(self):
+        with self._lock:
+            return list(self.entries.keys())
+
+    def expected_yield(self, key):
+        """Expected new matches per request for the interval key."""
+        with self._lock:
+            # Most specific estimate first: same time slot, same kind, anything.
+            for group in (_slot(key), _kind(key), None):
+                new, requests = self._totals.get(group, (0, 0))
+                if requests > 0:
+                    return new / requests
+        return _PRIOR_YIELD
+
+    def priority(self, interval):
+        """PriorityQueue priority for an interval, best expected yield first.
+
+        Ties, e.g. while the ledger is still empty, are broken by the
+        interval key, which sorts chronologically.
+        """
+        return (-self.expected_yield(interval.key()), interval.key())
+
+    def __getstate__(self):
+        with self._lock:
+            return {'entries': dict(self.entries)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for key, entry in state['entries'].items():
+            self.record(key, entry.returned, entry.new, entry.requests)
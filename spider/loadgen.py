@@ -0,0 +1,286 @@
+"""Synthetic load generator for the ingestion path.
+
+Produces getmatchdetailsbatch shaped player records and match id streams and
+feeds them through Overwatch, the spider's own fetch_matches threads and the
+database writers without touching the Paladins API, then reports sustained
+rows/s, Overwatch memory growth and database size growth. Like in the
+spider, fetch_matches starts after 10s and idles for a minute whenever the
+backlog runs dry, so runs should be minutes long.
+
+    python loadgen.py --rate 2000 --duration 300 --duplicate-ratio 0.2
+"""
+import argparse
+import datetime
+import logging
+import random
+import resource
+import sys
+import threading
+import time
+
+import db
+import spider
+from paladins import PaladinsAPI
+from spider import Fetcher, Overwatch, DB_WRITERS
+
+# Players per match, 5v5.
+PLAYERS_PER_MATCH = 10
+
+# Every ten seconds we log progress.
+REPORT_INTERVAL = 10
+
+class SyntheticMatches(object):
+    """Deterministic source of fake match ids and match details."""
+    def __init__(self, champions, maps, players, duplicate_ratio, seed=0):
+        self.random = random.Random(seed)
+        self.champions = [f"Champion {i}" for i in range(champions)]
+        self.maps = [f"Map {i}" for i in range(maps)]
+        self.players = [(1000000+i, f"player{i}") for i in range(players)]
+        self.duplicate_ratio = duplicate_ratio
+        self.next_match_id = 900000000
+        self.issued = []
+
+    def match_ids(self, n):
+        ids = []
+        for _ in range(n):
+            if self.issued and self.random.random() < self.duplicate_ratio:
+                ids.append(self.random.choice(self.issued))
+                continue
+            match_id = str(self.next_match_id)
+            self.next_match_id += 1
+            self.issued.append(match_id)
+            ids.append(match_id)
+        # Only recent ids are re-issued, like overlapping intervals would.
+        del self.issued[:-10000]
+        return ids
+
+    def details(self, match_id):
+        r = self.random
+        map_name = r.choice(self.maps)
+        team1_score, team2_score = r.choice([(4, r.randint(0, 3)), (r.randint(0, 3), 4)])
+        duration = r.randint(400, 1500)
+        date = datetime.datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")
+        party_id = r.randint(1, 10**8)
+        records = []
+        for i, (player_id, player_name) in enumerate(r.sample(self.players, PLAYERS_PER_MATCH)):
+            team = 1 + i % 2
+            won = (team == 1) == (team1_score > team2_score)
+            records.append({
+                'Account_Level': r.randint(1, 150),
+                'Assists': r.randint(0, 40),
+                'Reference_Name': r.choice(self.champions),
+                'Damage_Player': r.randint(0, 200000),
+                'Damage_Taken': r.randint(0, 200000),
+                'Deaths': r.randint(0, 20),
+                'Gold_Earned': r.randint(1000, 20000),
+                'Entry_Datetime': date,
+                'Healing_Player_Self': r.randint(0, 50000),
+                'Healing': r.randint(0, 150000),
+                'Damage_Mitigated': r.randint(0, 100000),
+                'Item_Purch_1': f"Card {r.randint(1, 16)}",
+                'Item_Purch_2': f"Card {r.randint(1, 16)}",
+                'Item_Purch_3': f"Card {r.randint(1, 16)}",
+                'Item_Purch_4': f"Card {r.randint(1, 16)}",
+                'Item_Purch_5': f"Card {r.randint(1, 16)}",
+                'ItemLevel1': r.randint(1, 5),
+                'ItemLevel2': r.randint(1, 5),
+                'ItemLevel3': r.randint(1, 5),
+                'ItemLevel4': r.randint(1, 5),
+                'ItemLevel5': r.randint(1, 5),
+                'Item_Active_1': f"Item {r.randint(1, 16)}",
+                'Item_Active_2': f"Item {r.randint(1, 16)}",
+                'Item_Active_3': f"Item {r.randint(1, 16)}",
+                'Item_Active_4': f"Item {r.randint(1, 16)}",
+                'ActiveLevel1': r.randint(0, 3),
+                'ActiveLevel2': r.randint(0, 3),
+                'ActiveLevel3': r.randint(0, 3),
+                'ActiveLevel4': r.randint(0, 3),
+                'Item_Purch_6': f"Talent {r.randint(1, 3)}",
+                'Killing_Spree': r.randint(0, 15),
+                'Kills_Player': r.randint(0, 40),
+                'Map_Game': map_name,
+                'Match': int(match_id),
+                'Time_In_Match_Seconds': duration,
+                'Multi_kill_Max': r.randint(0, 5),
+                'Objective_Assists': r.randint(0, 300),
+                'PartyId': party_id + i // 2,
+                'Platform': "PC",
+                'Region': "Europe",
+                'Team1Score': team1_score,
+                'Team2Score': team2_score,
+                'TaskForce': team,
+                'Win_Status': "Winner" if won else "Loser",
+                'playerId': player_id,
+                'playerName': player_name,
+                'Mastery_Level': r.randint(0, 100),
+            })
+        return records
+
+class OfflineDatabase(object):
+    """Stands in for db.Database with --no-db, to load only Overwatch."""
+    def fetched_match_ids(self, match_ids):
+        return set()
+
+class OfflineWriters(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = 0
+
+    def submit(self, matches, on_done=None, on_error=None):
+        with self._lock:
+            self.rows += len(matches)
+        if on_done is not None:
+            on_done()
+
+    def join(self, timeout=None):
+        return True
+
+class SyntheticAPI(object):
+    """Stands in for PaladinsAPI in fetch_matches, answering from a SyntheticMatches."""
+    MAX_MATCH_BATCH = PaladinsAPI.MAX_MATCH_BATCH
+
+    def __init__(self, source, lock):
+        self.source = source
+        # The source is shared with the producer and is not thread-safe.
+        self.lock = lock
+
+    def get_match_batch(self, match_ids):
+        with self.lock:
+            return [record for match_id in match_ids for record in self.source.details(match_id)]
+
+class LoadFetcher(Fetcher):
+    """Fetcher answering from a SyntheticAPI, counting failed dedup queries."""
+    def __init__(self, db, writers, api):
+        super().__init__(None, db, writers)
+        self.api = api
+        self._errors_lock = threading.Lock()
+        self.errors = 0
+
+    def unfetched(self, match_ids):
+        try:
+            return super().unfetched(match_ids)
+        except Exception:
+            with self._errors_lock:
+                self.errors += 1
+            raise
+
+def overwatch_memory(overwatcher):
+    """Approximate bytes held by the Overwatch queues and bookkeeping."""
+    return (overwatcher.match_ids.nbytes()
+        + sys.getsizeof(overwatcher.fetched) + sys.getsizeof(overwatcher.working))
+
+def database_size(database):
+    if isinstance(database, OfflineDatabase):
+        return 0
+    def query(cur):
+        cur.execute("SELECT pg_total_relation_size('match_details')")
+        return cur.fetchone()[0]
+    return database.run(query)
+
+class LoadGenerator(object):
+    def __init__(self, source, overwatcher, fetcher, rate, fetchers):
+        self.source = source
+        self.overwatcher = overwatcher
+        self.fetcher = fetcher
+        self.rate = rate
+        self.fetchers = fetchers
+        self.produced = 0
+
+    @property
+    def rows(self):
+        """Rows the writers actually inserted."""
+        return self.fetcher.writers.rows
+
+    @property
+    def errors(self):
+        """Failed dedup queries."""
+        return self.fetcher.errors
+
+    def produce(self):
+        # Ticks of a tenth of a second, --rate 0 produces as fast as possible.
+        tick = 0.1
+        start = time.monotonic()
+        while not spider.SHUTDOWN.is_set():
+            if self.rate > 0:
+                # Paced per id, so rates below one id per tick are kept too.
+                n = int(self.rate*(time.monotonic() - start)) - self.produced
+            else:
+                n = 1000
+            if n > 0:
+                with self.fetcher.api.lock:
+                    match_ids = self.source.match_ids(n)
+                self.overwatcher.put_matches(match_ids)
+                self.produced += n
+            if self.rate > 0:
+                spider.SHUTDOWN.wait(tick)
+
+    def run(self, duration):
+        threads = [threading.Thread(name='loadgen_produce', target=self.produce, daemon=True)]
+        # The real match fetchers, stopped like the spider is on SIGTERM.
+        for i in range(self.fetchers):
+            threads.append(threading.Thread(
+                name=f'fetch_matches_{i}',
+                target=spider.fetch_matches,
+                args=(self.fetcher, self.overwatcher),
+                daemon=True))
+        for thread in threads:
+            thread.start()
+
+        start = time.monotonic()
+        while time.monotonic() - start < duration:
+            time.sleep(min(REPORT_INTERVAL, duration - (time.monotonic() - start)))
+            elapsed = time.monotonic() - start
+            logging.info(f"[Load] {elapsed:.0f}s: produced {self.produced} ids, {self.rows} rows ({self.rows/elapsed:.0f} rows/s), {self.errors} errors, backlog {len(self.overwatcher.match_ids)}, overwatch {overwatch_memory(self.overwatcher)/2**20:.1f} MiB")
+
+        spider.SHUTDOWN.set()
+        for thread in threads:
+            thread.join()
+        # Sustained throughput includes waiting for the writers to flush.
+        self.fetcher.writers.join()
+        return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the ingestion path with synthetic matches.")
+    parser.add_argument("--rate", type=float, default=1000, help="match ids produced per second, 0 for unbounded")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--champions", type=int, default=45)
+    parser.add_argument("--maps", type=int, default=12)
+    parser.add_argument("--players", type=int, default=100000)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1, help="fraction of ids that repeat a recent id")
+    parser.add_argument("--fetchers", type=int, default=1, help="threads draining the backlog")
+    parser.add_argument("--writers", type=int, default=DB_WRITERS, help="parallel database writers")
+    parser.add_argument("--no-db", action="store_true", help="skip Postgres, only load Overwatch")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.no_db:
+        database, writers = OfflineDatabase(), OfflineWriters()
+    else:
+        database = db.Database(db.dsn_from_env(), args.writers + args.fetchers)
+        writers = db.Writers(database, args.writers)
+        writers.start()
+
+    source = SyntheticMatches(args.champions, args.maps, args.players, args.duplicate_ratio, args.seed)
+    overwatcher = Overwatch()
+    fetcher = LoadFetcher(database, writers, SyntheticAPI(source, threading.Lock()))
+
+    db_size_before = database_size(database)
+    memory_before = overwatch_memory(overwatcher)
+
+    generator = LoadGenerator(source, overwatcher, fetcher, args.rate, args.fetchers)
+    elapsed = generator.run(args.duration)
+
+    db_size_after = database_size(database)
+    memory_after = overwatch_memory(overwatcher)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    logging.info(f"[Load] Produced {generator.produced} match ids in {elapsed:.1f}s")
+    logging.info(f"[Load] Inserted {generator.rows} rows, sustained {generator.rows/elapsed:.0f} rows/s")
+    logging.info(f"[Load] Dedup query errors: {generator.errors}")
+    logging.info(f"[Load] Backlog left: {len(overwatcher.match_ids)} match ids")
+    logging.info(f"[Load] Overwatch memory: {memory_before/2**20:.1f} MiB -> {memory_after/2**20:.1f} MiB")
+    logging.info(f"[Load] Database size: {db_size_before/2**20:.1f} MiB -> {db_size_after/2**20:.1f} MiB (+{(db_size_after-db_size_before)/2**20:.1f} MiB)")
+    logging.info(f"[Load] Max RSS: {max_rss/1024:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
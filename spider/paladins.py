@@ -8,6 +8,8 @@ import threading
 
 BASE_URL = "http://api.paladins.com/paladinsapi.svc"
 RESPONSE_FORMAT = "Json"
+# Seconds before a request is abandoned, so no thread hangs on a dead socket.
+REQUEST_TIMEOUT = 30
 
 class Player():
     def __init__(self, response):
@@ -40,9 +42,12 @@ class Credentials():
 
 class PaladinsAPI(object):
     MAX_MATCH_BATCH = 25
-    def __init__(self, credentials, session):
+    def __init__(self, credentials, session, retry_policy=None):
         self.session = session
         self.credentials = credentials
+        self.retry_policy = retry_policy
+        # Requests sent by the last _call on each thread, retries included.
+        self._local = threading.local()
 
     def base_url(self, method):
         sig, timestamp = signature(self.credentials, method)
@@ -52,19 +57,34 @@ class PaladinsAPI(object):
         return f"{BASE_URL}/{method}{RESPONSE_FORMAT}/{self.credentials.dev_id}/{sig}/{self.session.id}/{timestamp}"
 
     def _request(self, endpoint):
-        self.session.handler.allow_request()
-        contents = urllib.request.urlopen(endpoint).read()
+        if not self.session.handler.allow_request():
+            raise RequestLimitException()
+        self._local.requests += 1
+        contents = urllib.request.urlopen(endpoint, timeout=REQUEST_TIMEOUT).read()
         return contents
 
+    def last_requests(self):
+        """Requests the last call on this thread spent, whether it failed or not."""
+        return getattr(self._local, 'requests', 0)
+
+    def _call(self, method, path=""):
+        # The endpoint is rebuilt on every attempt, since a retry may happen
+        # after the signature timestamp or the session has gone stale.
+        def request():
+            endpoint = f"{self.base_url(method)}{path}"
+            logging.debug(endpoint)
+            return json.loads(self._request(endpoint))
+
+        self._local.requests = 0
+        if self.retry_policy is None:
+            return request()
+        return self.retry_policy.call(method, request)
+
     def get_player(self, player_name):
         method = "getplayer"
 
         encoded_player_name = urllib.request.quote(player_name.encode('utf-8'))
-        endpoint = f"{self.base_url(method)}/{encoded_player_name}"
-        logging.debug(endpoint)
-
-        contents = self._request(endpoint)
-        response = json.loads(contents)
+        response = self._call(method, f"/{encoded_player_name}")
         logging.debug(response[0])
         return Player(response[0])
 
@@ -72,13 +92,8 @@ class PaladinsAPI(object):
         method = "getmatchhistory"
         logging.debug(player.id)
 
-        endpoint = f"{self.base_url(method)}/{player.id}"
-        logging.debug(endpoint)
-
-        contents = self._request(endpoint)
-        print(contents.decode('utf-8'))
-        # response = json.loads(contents)
-        # print(response)
+        response = self._call(method, f"/{player.id}")
+        print(response)
 
     def get_match_batch(self, match_ids):
         # Create a function called "chunks" with two arguments, l and n:
@@ -102,22 +117,14 @@ class PaladinsAPI(object):
         method = "getmatchdetailsbatch"
 
         match_ids_string = ",".join(match_ids)
-        endpoint = f"{self.base_url(method)}/{match_ids_string}"
-        logging.debug(endpoint)
-
-        contents = self._request(endpoint)
-        matches = json.loads(contents)
+        matches = self._call(method, f"/{match_ids_string}")
         return matches
 
 
     def get_match_ids_by_queue(self, gameplay_mode, date, hour):
         method = "getmatchidsbyqueue"
 
-        endpoint = f"{self.base_url(method)}/{gameplay_mode.value}/{date}/{hour}"
-        logging.debug(endpoint)
-
-        contents = self._request(endpoint)
-        response = json.loads(contents)
+        response = self._call(method, f"/{gameplay_mode.value}/{date}/{hour}")
         match_ids = [ obj["Match"] for obj in response ]
         return match_ids
 
@@ -125,28 +132,18 @@ class PaladinsAPI(object):
     def get_data_used(self):
         method = "getdataused"
 
-        endpoint = f"{self.base_url(method)}"
-        logging.debug(endpoint)
-
-        contents = self._request(endpoint)
-
-        print(contents.decode('utf-8'))
-        data_usage = json.loads(contents)
+        data_usage = self._call(method)
         return data_usage
 
 def signature(credentials, method_name):
-    logging.debug(credentials)
-    logging.debug(method_name)
-
     now = datetime.datetime.utcnow()
     timestamp = now.strftime("%Y%m%d%H%M%S")
 
-    logging.debug(now)
-    logging.debug(timestamp)
-
     payload = f"{credentials.dev_id}{method_name}{credentials.auth_key}{timestamp}".encode('utf-8')
     signature = hashlib.md5(payload).hexdigest()
-    logging.debug(signature)
+
+    # Hot path, keep formatting lazy so it costs nothing when disabled.
+    logging.debug("Signature for %s by %s at %s: %s", method_name, credentials.dev_id, timestamp, signature)
 
     return signature, timestamp
 
@@ -158,8 +155,9 @@ class Session():
         self.created = datetime.datetime.now()
 
     def _request(self, endpoint):
-        self.handler.allow_request()
-        contents = urllib.request.urlopen(endpoint).read()
+        if not self.handler.allow_request():
+            raise RequestLimitException()
+        contents = urllib.request.urlopen(endpoint, timeout=REQUEST_TIMEOUT).read()
         return contents
 
     def _create(self, credentials):
@@ -225,6 +223,9 @@ class SessionHandler(object):
         self.sessions = []
         self.credentials = credentials
         self.total_requests = AtomicInteger(0)
+        # The request limit is per UTC day.
+        self.day = datetime.datetime.utcnow().date()
+        self.day_lock = threading.Lock()
 
     def create(self):
         # TODO(godbit): Fix this.
@@ -234,9 +235,14 @@ class SessionHandler(object):
         return session
 
     def allow_request(self):
+        today = datetime.datetime.utcnow().date()
+        with self.day_lock:
+            if today != self.day:
+                self.day = today
+                self.total_requests = AtomicInteger(0)
+
         if self.total_requests.inc() >= self._REQUESTS_DAY_LIMIT:
             self.total_requests.dec()
-            # TODO(_): Raise exception?
             return False
         return True
 
@@ -0,0 +1,120 @@
+import contextlib
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# Profiling is opt-in, set SPIDER_PROFILE=1 to enable it.
+ENABLED = os.getenv("SPIDER_PROFILE") in ("1", "true", "yes")
+
+# Where collapsed-stack files are written.
+PROFILE_FOLDER = os.getenv("SPIDER_PROFILE_FOLDER", "/tmp")
+
+# How often every thread's stack is sampled, in seconds.
+SAMPLE_INTERVAL = float(os.getenv("SPIDER_PROFILE_INTERVAL", "0.01"))
+
+# Every minute we dump samples and stage timings.
+DUMP_INTERVAL = 60*1
+
+class StageTimer(object):
+    """Accumulates wall clock time spent in named API/DB stages."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = collections.Counter()
+        self._total = collections.Counter()
+        self._max = {}
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._count[name] += 1
+                self._total[name] += elapsed
+                self._max[name] = max(self._max.get(name, 0.0), elapsed)
+
+    def log(self):
+        with self._lock:
+            for name in sorted(self._total):
+                count = self._count[name]
+                total = self._total[name]
+                logging.info("[Profile] %s: calls %d, total %.3fs, mean %.1fms, max %.1fms",
+                    name, count, total, 1000*total/count, 1000*self._max[name])
+
+class StackSampler(object):
+    """Periodically samples the stacks of all named threads.
+
+    Samples are kept per thread name in collapsed-stack format, i.e. one line
+    per unique stack with frames separated by ';' followed by the sample
+    count, which can be fed straight into flamegraph.pl or speedscope.
+    """
+    def __init__(self, folder=PROFILE_FOLDER, interval=SAMPLE_INTERVAL):
+        self.folder = folder
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(collections.Counter)
+
+    def sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        own = threading.get_ident()
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                self._samples[names.get(ident, str(ident))][";".join(stack)] += 1
+
+    def dump(self):
+        with self._lock:
+            samples = {name: dict(stacks) for name, stacks in self._samples.items()}
+        for name, stacks in samples.items():
+            filename = os.path.join(self.folder, f"profile-{name}.collapsed")
+            try:
+                with open(filename, 'w') as fp:
+                    for stack, count in stacks.items():
+                        fp.write(f"{stack} {count}\n")
+            except Exception as e:
+                logging.error(e)
+
+    def run(self):
+        logging.info("Starting profile_sampler")
+        next_dump = time.monotonic() + DUMP_INTERVAL
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if time.monotonic() < next_dump:
+                continue
+            next_dump += DUMP_INTERVAL
+            self.dump()
+            TIMER.log()
+
+TIMER = StageTimer()
+
+_NULL_STAGE = contextlib.nullcontext()
+
+def stage(name):
+    """Time the enclosed block as the given stage, a no-op unless enabled."""
+    if not ENABLED:
+        return _NULL_STAGE
+    return TIMER.time(name)
+
+def start():
+    """Start sampling thread stacks, if profiling is enabled."""
+    if not ENABLED:
+        return
+    logging.info(f"Profiling enabled, writing collapsed stacks to {PROFILE_FOLDER}")
+    threading.Thread(
+        name='profile_sampler',
+        target=StackSampler().run,
+        daemon=True).start()
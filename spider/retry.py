@@ -0,0 +1,152 @@
+import http.client
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import urllib.error
+from enum import Enum
+
+from paladins import RequestLimitException
+
+class ErrorKind(Enum):
+    transient = 1 # Worth retrying shortly, e.g. timeouts and 5xx.
+    quota     = 2 # Out of requests, nothing to do until the limit resets.
+    permanent = 3 # Retrying the same request will fail the same way.
+
+class CircuitOpenException(Exception):
+    def __init__(self, name, retry_in):
+        super().__init__(f"Circuit for {name} is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+def classify(e):
+    """Return the ErrorKind of an exception raised by an API call."""
+    if isinstance(e, RequestLimitException):
+        return ErrorKind.quota
+    if isinstance(e, urllib.error.HTTPError):
+        if e.code == 429:
+            return ErrorKind.quota
+        if e.code >= 500 or e.code == 408:
+            return ErrorKind.transient
+        return ErrorKind.permanent
+    # HTTPError is a URLError, so this has to come after it.
+    if isinstance(e, (urllib.error.URLError, socket.timeout, ConnectionError, http.client.HTTPException)):
+        return ErrorKind.transient
+    # Hi-Rez answers with an HTML error page when overloaded.
+    if isinstance(e, json.JSONDecodeError):
+        return ErrorKind.transient
+    return ErrorKind.permanent
+
+class Backoff(object):
+    """Exponential backoff with full jitter."""
+    def __init__(self, base=1.0, cap=15*60):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+class CircuitBreaker(object):
+    """Stops calls to an endpoint after repeated failures.
+
+    After `threshold` consecutive failures the circuit opens and calls are
+    refused for `reset_timeout` seconds, then a single trial call is let
+    through. Its outcome either closes the circuit or opens it again.
+    """
+    def __init__(self, name, threshold=5, reset_timeout=5*60):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._trial:
+                raise CircuitOpenException(self.name, max(retry_in, 1))
+            # Half-open, let one call through.
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit for {self.name} closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._opened_at is None and self._failures < self.threshold:
+                return
+            self._opened_at = time.monotonic()
+            logging.warning(f"Circuit for {self.name} opened after {self._failures} failures")
+
+    def record_inconclusive(self):
+        """Record a call that says nothing about the endpoint, e.g. out of quota.
+
+        A failed trial call goes back to plain open without counting a
+        failure, otherwise the circuit would stay half-open forever.
+        """
+        with self._lock:
+            if not self._trial:
+                return
+            self._trial = False
+            self._opened_at = time.monotonic()
+
+class RetryPolicy(object):
+    """Retries transient errors with backoff, guarded by per-endpoint circuit breakers."""
+    def __init__(self, max_attempts=4, backoff=None, threshold=5, reset_timeout=5*60):
+        self.max_attempts = max_attempts
+        self.backoff = backoff or Backoff()
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, name):
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, self.threshold, self.reset_timeout)
+            return self._breakers[name]
+
+    def call(self, name, fn):
+        """Call fn, retrying transient failures.
+
+        Quota and permanent errors, as well as the last transient error, are
+        re-raised to the caller which is responsible for re-queueing its work.
+        """
+        breaker = self.breaker(name)
+        attempt = 0
+        while True:
+            breaker.allow()
+            try:
+                result = fn()
+            except Exception as e:
+                kind = classify(e)
+                # Running out of quota says nothing about the endpoint health.
+                if kind == ErrorKind.quota:
+                    breaker.record_inconclusive()
+                else:
+                    breaker.record_failure()
+                attempt += 1
+                if kind != ErrorKind.transient or attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff.delay(attempt)
+                logging.warning(f"Transient error on {name} ({e}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+# Shared by all API clients, so breakers trip per endpoint rather than per thread.
+DEFAULT_POLICY = RetryPolicy()
@@ -2,17 +2,22 @@ import json
 import logging
 import os
 import datetime
+import heapq
 import queue
 import time
 import threading
 import os.path
 import pickle
-from collections import deque
+import signal
 
-import psycopg2
-
-from paladins import PaladinsAPI, Credentials, GameMode, MatchDetails
-from paladins import RequestLimitException, SessionHandler
+import db
+import ledger
+import profiling
+import retry
+# Old pickles refer to __main__.MatchBacklog.
+from backlog import MatchBacklog
+from paladins import PaladinsAPI, Credentials, GameMode
+from paladins import SessionHandler
 
 # Log data usage every 5 minutes.
 LOG_DATA_USAGE_INTERVAL = 60 * 5
@@ -26,6 +31,20 @@ REMOVE_INTERVALS_INTERVAL = 24*3600*1
 # Every minute we generate all possible intervals for overwatcher.
 GENERATE_INTERVALS_INTERVAL = 60*1
 
+# Set on SIGTERM/SIGINT, fetch threads then drain and main writes a final checkpoint.
+SHUTDOWN = threading.Event()
+
+# Seconds to drain before the final checkpoint is written anyway, kept below
+# the stop_grace_period in docker-compose.yml.
+SHUTDOWN_TIMEOUT = 90
+
+# Wait after a failed match batch, growing with consecutive failures.
+MATCH_BACKOFF = retry.Backoff(base=10, cap=15*60)
+
+# Number of parallel database writers. Set POSTGRES_WRITERS to the core count
+# of the database host, which we cannot see from here.
+DB_WRITERS = int(os.getenv("POSTGRES_WRITERS", 4))
+
 def path(filename):
     """Return an absolute path to a file in the current directory."""
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)
@@ -39,63 +58,39 @@ with open('dev-key.json', 'r') as fp:
     CREDENTIALS = Credentials(json_credentials)
 
 class Fetcher(object):
-    def __init__(self, session):
-        postgres_username = os.getenv("POSTGRES_USERNAME")
-        postgres_password = os.getenv("POSTGRES_PASSWORD")
-        postgres_database = os.getenv("POSTGRES_DATABASE")
-        postgres_hostname = os.getenv("POSTGRES_HOSTNAME")
-
-        self.conn = psycopg2.connect(
-            f"dbname={postgres_database} user={postgres_username} password={postgres_password} host={postgres_hostname}")
-
-        self.api = PaladinsAPI(CREDENTIALS, session)
-
-    def destroy(self):
-        self.conn.close()
-
-    def insert_matches(self, matches):
-        cur = self.conn.cursor()
-        for match_obj in matches:
-            md = MatchDetails(match_obj)
+    def __init__(self, session, db, writers):
+        self.db = db
+        self.writers = writers
+        self.api = PaladinsAPI(CREDENTIALS, session, retry.DEFAULT_POLICY)
 
-            insert_query = "INSERT INTO match_details (account_level,assists,champion,damage_dealt,damage_taken,deaths,credits,match_date,self_healing,healing,shielding,loadout_card1,loadout_card2,loadout_card3,loadout_card4,loadout_card5,loadout_card1_level,loadout_card2_level,loadout_card3_level,loadout_card4_level,loadout_card5_level,item1,item2,item3,item4,item1_level,item2_level,item3_level,item4_level,talent,streak,kills,map,match_id,match_duration,highest_multi_kill,objective_time,party_id,platform,region,team1_score,team2_score,team,win_status,player_id,player_name,master_level) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) on conflict (match_id, player_name) do nothing;"
+    def insert_matches(self, matches, on_done=None, on_error=None):
+        self.writers.submit(matches, on_done, on_error)
 
-            values = md.as_tuple()
-            try:
-                cur.execute(insert_query, values)
-            except psycopg2.IntegrityError as ie:
-                logging.error(f"Unexpected error: {ie}")
-                continue
-
-        self.conn.commit()
-        cur.close()
-
-
-    def track_exists(self, track_id):
-        cur = self.conn.cursor()
-        cur.execute("SELECT fma_track_id FROM tracks WHERE fma_track_id = %s", (track_id,))
-
-    def is_already_fetched(self, match_id):
-        cur = self.conn.cursor()
-        cur.execute("SELECT exists (select 1 FROM match_details WHERE match_id = %s)", (match_id,))
-
-        exists = cur.fetchone()[0]
-
-        self.conn.commit()
-        cur.close()
-        return exists
+    def unfetched(self, match_ids):
+        """Return the match ids not yet in the database, in order."""
+        fetched = self.db.fetched_match_ids(match_ids)
+        return [match_id for match_id in match_ids if match_id not in fetched]
 
 
 class CheckableQueue(queue.PriorityQueue):
-    def __contains__(self, item):
+    def __contains__(self, key):
         with self.mutex:
-            return item in self.queue
+            return any(interval.key() == key for _, interval in self.queue)
+
+    def reprioritize(self, priority):
+        """Recompute the priority of every queued interval."""
+        with self.mutex:
+            self.queue[:] = [(priority(interval), interval) for _, interval in self.queue]
+            heapq.heapify(self.queue)
 
 class Interval(object):
     def __init__(self, date, hour):
         self.date = date
         self.hour = hour
         self.fail_count = 0
+        self.prio = 0
+        # API requests spent on this interval so far, failed attempts included.
+        self.requests = 0
 
     def key(self):
         return f"{self.date}{self.hour}"
@@ -117,14 +112,27 @@ class Overwatch(object):
     _COMPLETED_INTERVALS_FRESH_FILE = f"{folder}/completed-intervals-fresh.pickle"
     _COMPLETED_MATCH_FINAL_FILE     = f"{folder}/completed-match-final.pickle"
     _COMPLETED_INTERVALS_FINAL_FILE = f"{folder}/completed-intervals-final.pickle"
+    _YIELD_LEDGER_FRESH_FILE        = f"{folder}/yield-ledger-fresh.pickle"
+    _YIELD_LEDGER_FINAL_FILE        = f"{folder}/yield-ledger-final.pickle"
 
     _MAX_FAILS = 5
+    # Failed intervals are retried after a delay, rather than immediately.
+    _INTERVAL_BACKOFF = retry.Backoff(base=60, cap=60*60)
+    # How long get_interval waits for an interval before raising queue.Empty,
+    # kept short so fetch_intervals notices a shutdown quickly.
+    _GET_INTERVAL_TIMEOUT = 5
+
     def __init__(self):
         self.fetched = {}
         self.working = {}
         self.intervals = CheckableQueue()
+        # Heap of (retry_at, prio, interval) waiting for their backoff to pass.
+        self.delayed = []
+        self.delayed_lock = threading.Lock()
+        self.save_lock = threading.Lock()
         self.session_handler = SessionHandler(CREDENTIALS)
-        self.match_ids = deque()
+        self.match_ids = MatchBacklog()
+        self.ledger = ledger.YieldLedger()
 
     def interval_generator(self):
         day = datetime.datetime.now() - datetime.timedelta(days=31)
@@ -184,11 +192,21 @@ class Overwatch(object):
             self.fetched = fetched
         match_ids = _load(self._COMPLETED_MATCH_FINAL_FILE, self._COMPLETED_MATCH_FRESH_FILE)
         if match_ids:
+            # Older backups pickled a plain deque of match ids.
+            if not isinstance(match_ids, MatchBacklog):
+                match_ids = MatchBacklog(match_ids)
             self.match_ids = match_ids
+        yield_ledger = _load(self._YIELD_LEDGER_FINAL_FILE, self._YIELD_LEDGER_FRESH_FILE)
+        if yield_ledger:
+            self.ledger = yield_ledger
 
         self.remove_old_intervals()
 
     def save(self):
+        with self.save_lock:
+            self._save()
+
+    def _save(self):
         # We can only recover intervals, but not matches. Therefore, it is of
         # most importance to ensure that matches are correctly persisted. Since
         # in the worst case we can reproduce them from the intervals that have
@@ -198,11 +216,15 @@ class Overwatch(object):
                 pickle.dump(self.match_ids, fp)
             with open(self._COMPLETED_INTERVALS_FRESH_FILE, 'wb') as fp:
                 pickle.dump(self.fetched, fp)
+            with open(self._YIELD_LEDGER_FRESH_FILE, 'wb') as fp:
+                pickle.dump(self.ledger, fp)
             time.sleep(1)
             with open(self._COMPLETED_MATCH_FINAL_FILE, 'wb') as fp:
                 pickle.dump(self.match_ids, fp)
             with open(self._COMPLETED_INTERVALS_FINAL_FILE, 'wb') as fp:
                 pickle.dump(self.fetched, fp)
+            with open(self._YIELD_LEDGER_FINAL_FILE, 'wb') as fp:
+                pickle.dump(self.ledger, fp)
         except Exception as e:
             logging.error(e)
 
@@ -218,43 +240,61 @@ class Overwatch(object):
                 return False
             return True
 
-        # Generate all previous intervals (1 month back).
-        prio = 1
-        for interval in self.interval_generator():
-            key = interval.key()
-            if not is_new(key):
-                return
-            self.intervals.put((prio, interval))
-            prio += 1
-
-        # Generate todays intervals, at most 10 minutes behind.
-        for interval in self.today_interval_generator():
-            key = interval.key()
-            if not is_new(key):
-                return
-            self.intervals.put((prio, interval))
-            prio += 1
+        # Intervals are fetched in order of expected new matches per request,
+        # which changes as the ledger fills, so rank pending ones again.
+        self.intervals.reprioritize(self.ledger.priority)
+
+        # Generate all previous intervals (1 month back), and todays
+        # intervals, at most 10 minutes behind.
+        for generator in (self.interval_generator, self.today_interval_generator):
+            for interval in generator():
+                key = interval.key()
+                if not is_new(key):
+                    continue
+                self.intervals.put((self.ledger.priority(interval), interval))
+
+    def _release_delayed(self):
+        now = time.monotonic()
+        with self.delayed_lock:
+            while self.delayed and self.delayed[0][0] <= now:
+                _, _, interval = heapq.heappop(self.delayed)
+                self.intervals.put((self.ledger.priority(interval), interval))
 
     def get_interval(self):
         while True:
-            prio, interval = self.intervals.get()
+            self._release_delayed()
+            prio, interval = self.intervals.get(timeout=self._GET_INTERVAL_TIMEOUT)
             if interval.fail_count >= self._MAX_FAILS:
-                logging.error("Abandoning this shit: {interval.key()}")
+                logging.error(f"Abandoning this shit: {interval.key()}")
+                # No longer pending, so a later generate_intervals pass can
+                # queue it again with a fresh failure budget.
+                self.working.pop(interval.key(), None)
                 continue
-            logging.debug(f"PriorityQueue prio: {prio}")
+            logging.debug("PriorityQueue prio: %s", prio)
             break
 
+        interval.prio = prio
         self.working[interval.key()] = True
         return interval
 
-    def put_back_interval(self, interval):
-        interval.fail_count += 1
-        self.intervals.put((0, interval))
-        pass
-
-    def register_finish(self, interval):
+    def put_back_interval(self, interval, delay=None, count_failure=True):
+        """Return an unfinished interval, to be retried after a backoff delay.
+
+        Intervals are ranked again when released, and stay in working while
+        delayed, so generate_intervals does not queue them twice.
+        """
+        if count_failure:
+            interval.fail_count += 1
+        if delay is None:
+            delay = self._INTERVAL_BACKOFF.delay(interval.fail_count)
+        with self.delayed_lock:
+            heapq.heappush(self.delayed, (time.monotonic()+delay, interval.prio, interval))
+
+    def register_finish(self, interval, returned, new):
+        """Mark an interval as fetched, recording how much it yielded."""
         del self.working[interval.key()]
         self.fetched[interval.key()] = True
+        self.ledger.record(interval.key(), returned, new, interval.requests)
 
     def remove_old_intervals(self):
         now = datetime.datetime.now()
@@ -265,25 +305,32 @@ class Overwatch(object):
             difference = now - date
             return difference > datetime.timedelta(days=32)
 
-        for k in self.fetched.keys():
+        for k in list(self.fetched.keys()):
             if not is_old(k):
                 continue
             # Remove old intervals.
             del self.fetched[k]
 
+        for k in self.ledger.keys():
+            if is_old(k):
+                self.ledger.remove(k)
+
     def create_session(self):
         return self.session_handler.create()
 
     def put_matches(self, match_ids):
-        for id in match_ids:
-            self.match_ids.append(id)
+        return self.match_ids.put(match_ids)
+
+    def put_back_matches(self, matches, failed=False):
+        dropped = self.match_ids.put_back(matches, failed)
+        if dropped:
+            logging.error(f"Abandoning matches after {MatchBacklog._MAX_FAILS} failures: {dropped}")
 
-    def put_back_matches(self, matches):
-        for match in matches:
-            self.match_ids.append(match)
+    def finish_matches(self, matches):
+        self.match_ids.done(matches)
 
-    def get_match(self):
-        return self.match_ids.popleft()
+    def get_matches(self, n):
+        return self.match_ids.get_batch(n)
 
 def parse_date(interval_str):
     try:
@@ -299,12 +346,19 @@ def time_to_next_day():
     tomorrow = datetime.datetime(
         year=now.year,
         month=now.month,
-        day=now.day+1,
-        minute=1)
+        day=now.day,
+        minute=1) + datetime.timedelta(days=1)
 
     til_next_day = tomorrow - now
     return til_next_day
 
+def wait_for_quota():
+    logging.info("Reached request limit for today, good job!")
+    til_next_day = time_to_next_day().total_seconds()
+
+    # Sleep at most one hour.
+    SHUTDOWN.wait(min(til_next_day, 3600))
+
 def remove_old_intervals(overwatcher):
     logging.info("Starting persist_overwatcher")
     while True:
@@ -314,8 +368,8 @@ def remove_old_intervals(overwatcher):
 
 def persist_overwatcher(overwatcher):
     logging.info("Starting remove_old_intervals")
-    while True:
-        time.sleep(PERSIST_INTERVAL)
+    # The final save on shutdown is done by main, once all work is drained.
+    while not SHUTDOWN.wait(PERSIST_INTERVAL):
         logging.info("Saving overwatcher")
         try:
             overwatcher.save()
@@ -332,117 +386,143 @@ def generate_intervals(overwatcher):
         logging.info("Finished generating intervals")
         time.sleep(GENERATE_INTERVALS_INTERVAL)
 
+def wait_for_api(e):
+    """Log a failed API call and wait until it is worth calling again.
+
+    Returns True if the failure should count against the work item, i.e. it
+    was neither an open circuit nor exhausted quota.
+    """
+    if isinstance(e, retry.CircuitOpenException):
+        logging.warning(e)
+        SHUTDOWN.wait(e.retry_in)
+        return False
+    if retry.classify(e) == retry.ErrorKind.quota:
+        wait_for_quota()
+        return False
+    logging.error(f"Unexpected error: {e}")
+    return True
+
 def fetch_intervals(fetcher, overwatcher):
     logging.info("Starting fetch_intervals")
 
     log_count = 0
-    while True:
+    while not SHUTDOWN.is_set():
         try:
             interval = overwatcher.get_interval()
         except queue.Empty as e:
-            logging.debug(e)
-            time.sleep(60)
+            logging.debug("No intervals to fetch")
             continue
 
-        logging.debug(f"Got interval: {interval}")
+        logging.debug("Got interval: %s", interval)
 
         try:
-            match_ids = fetcher.api.get_match_ids_by_queue(
-                GameMode.siege,
-                interval.date,
-                interval.hour)
-        except RequestLimitException as re:
-            # Return interval we couldn't fetch.
-            overwatcher.put_back_interval(interval)
-
-            logging.info("Reached request limit for today, good job!")
-            til_next_day = time_to_next_day()
-
-            # Sleep at most one hour.
-            if til_next_day > 3600:
-                time.sleep(3600)
-            else:
-                time.sleep(til_next_day.seconds)
-            continue
+            with profiling.stage("api.getmatchidsbyqueue"):
+                match_ids = fetcher.api.get_match_ids_by_queue(
+                    GameMode.siege,
+                    interval.date,
+                    interval.hour)
         except Exception as e:
-            logging.error(f"Unexpected error: {e}")
+            interval.requests += fetcher.api.last_requests()
+            # Return interval we couldn't fetch.
+            failed = wait_for_api(e)
+            overwatcher.put_back_interval(interval, delay=None if failed else 0, count_failure=failed)
             continue
 
+        interval.requests += fetcher.api.last_requests()
         logging.debug(match_ids)
-        overwatcher.put_matches(match_ids)
+        try:
+            with profiling.stage("db.unfetched"):
+                new = fetcher.unfetched(match_ids)
+        except Exception as e:
+            # fetch_matches dedups against the database again anyway.
+            logging.error(f"Unexpected error: {e}")
+            new = match_ids
+        added = overwatcher.put_matches(new)
 
         # Do requests.
-        overwatcher.register_finish(interval)
+        overwatcher.register_finish(interval, len(match_ids), added)
 
         if log_count % 100 == 0 and log_count != 0:
             logging.info(f"[Intervals] Log count: {log_count}")
         log_count += 1
 
-# We know that a crash + save could lose information here.
+    logging.info("Stopped fetch_intervals")
+
+# Matches taken from the backlog are always put back unless they have been
+# inserted, so a failure costs at most a re-fetch, never a lost match id.
 def fetch_matches(fetcher, overwatcher):
     # Wait for intervals.
-    time.sleep(10)
+    SHUTDOWN.wait(10)
 
     logging.info("Starting fetch_matches")
     matches = []
+    fail_streak = 0
 
     log_count = 0
-    while True:
-        try:
-            match = overwatcher.get_match()
-        except IndexError as e:
-            logging.debug(e)
-            time.sleep(60)
+    while not SHUTDOWN.is_set():
+        batch = overwatcher.get_matches(fetcher.api.MAX_MATCH_BATCH - len(matches))
+        if not batch:
+            logging.debug("No matches in backlog")
+            SHUTDOWN.wait(60)
             continue
 
-        if fetcher.is_already_fetched(match):
+        try:
+            with profiling.stage("db.unfetched"):
+                new = fetcher.unfetched(batch)
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            overwatcher.put_back_matches(batch)
+            SHUTDOWN.wait(60)
             continue
+        matches.extend(new)
+        # Already in the database, nothing left to do for these.
+        overwatcher.finish_matches(set(batch) - set(new))
 
-        matches.append(match)
-
-        logging.debug(f"Got match: {match}")
+        logging.debug("Got matches: %s", batch)
         if len(matches) < fetcher.api.MAX_MATCH_BATCH:
             continue
 
-        logging.debug(f"Got match: {matches}")
+        logging.debug("Got match: %s", matches)
 
-        param = matches
-        matches = []
         try:
-            match_details = fetcher.api.get_match_batch(param)
-        except RequestLimitException as re:
-            # Return interval we couldn't fetch.
-            overwatcher.put_back_matches(matches)
-
-            logging.info("Reached request limit for today, good job!")
-            til_next_day = time_to_next_day()
-
-            # Sleep at most one hour.
-            if til_next_day > 3600:
-                time.sleep(3600)
-            else:
-                time.sleep(til_next_day.seconds)
-            continue
+            with profiling.stage("api.getmatchdetailsbatch"):
+                match_details = fetcher.api.get_match_batch(matches)
         except Exception as e:
-            logging.error(f"Unexpected error: {e}")
+            # Return matches we couldn't fetch, a batch that keeps failing is
+            # eventually dropped rather than spending requests forever.
+            failed = wait_for_api(e)
+            overwatcher.put_back_matches(matches, failed)
+            matches = []
+            if failed:
+                fail_streak += 1
+                SHUTDOWN.wait(MATCH_BACKOFF.delay(fail_streak))
             continue
+        fail_streak = 0
 
-        try:
-            fetcher.insert_matches(match_details)
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            continue
+        # Inserted asynchronously, failed inserts are put back by the writer.
+        fetcher.insert_matches(
+            match_details,
+            on_done=lambda matches=matches: overwatcher.finish_matches(matches),
+            on_error=lambda e, matches=matches: overwatcher.put_back_matches(matches))
+        matches = []
 
         if log_count % 100 == 0 and log_count != 0:
             logging.info(f"[Matches] Log count: {log_count}")
         log_count += 1
 
+    # Return the partial batch we were still collecting.
+    overwatcher.put_back_matches(matches)
+    logging.info("Stopped fetch_matches")
+
 
 def log_data_used(fetcher):
     logging.info("Starting log_data_used")
     while True:
-        data_used = fetcher.api.get_data_used()
-        logging.info(data_used)
+        try:
+            data_used = fetcher.api.get_data_used()
+            logging.info(data_used)
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
         time.sleep(LOG_DATA_USAGE_INTERVAL)
 
 
@@ -451,6 +531,8 @@ def main():
     logging.info("Reading old overwatcher")
     overwatcher.load()
 
+    profiling.start()
+
     # matches = api.get_match_batch(match_ids)
 
     # player_name = "döskalle"
@@ -481,10 +563,16 @@ def main():
         daemon=True,
         args=(overwatcher,)).start()
 
+    fetchers = 1
+    database = db.Database(db.dsn_from_env(), DB_WRITERS + 2*fetchers)
+    writers = db.Writers(database, DB_WRITERS)
+    writers.start()
+
+    workers = []
     fetcher = None
-    for i in range(1):
+    for i in range(fetchers):
         session = overwatcher.create_session()
-        fetcher = Fetcher(session)
+        fetcher = Fetcher(session, database, writers)
 
         threading.Thread(
             name='log_data_used',
@@ -492,15 +580,49 @@ def main():
             daemon=True,
             args=(fetcher,)).start()
 
-        threading.Thread(
+        # Daemons, so a thread stuck past the shutdown deadline can not keep
+        # the process alive after the final checkpoint.
+        workers.append(threading.Thread(
             name='fetch_intervals',
             target=fetch_intervals,
-            args=(fetcher,overwatcher)).start()
+            daemon=True,
+            args=(fetcher,overwatcher)))
 
-        threading.Thread(
+        workers.append(threading.Thread(
             name='fetch_matches',
             target=fetch_matches,
-            args=(fetcher,overwatcher)).start()
+            daemon=True,
+            args=(fetcher,overwatcher)))
+
+    for worker in workers:
+        worker.start()
+
+    SHUTDOWN.wait()
+    logging.info("Shutting down, draining in-flight work")
+
+    # Fetch threads finish their current request and put back unfinished
+    # work, then the writers flush everything that was fetched.
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+        if worker.is_alive():
+            logging.warning(f"{worker.name} did not stop in time")
+    if not writers.join(max(0, deadline - time.monotonic())):
+        # Anything a writer is still working on is in flight in the backlog,
+        # and in-flight match ids are saved with it.
+        logging.warning("Writers did not finish in time, putting back pending inserts")
+        writers.cancel_pending(RuntimeError("shutdown"))
+
+    logging.info("Saving overwatcher")
+    overwatcher.save()
+    database.close()
+    logging.info("Shutdown complete")
+
+def request_shutdown(signum, frame):
+    logging.info(f"Received {signal.Signals(signum).name}")
+    SHUTDOWN.set()
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
     main()
@@ -0,0 +1,112 @@
+import collections
+import importlib
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+import backlog
+from backlog import IdTable, MatchBacklog
+
+def import_spider(folder):
+    # spider reads dev-key.json from the working directory on import.
+    with open(os.path.join(folder, 'dev-key.json'), 'w') as fp:
+        json.dump({"devId": "0", "authKey": "0"}, fp)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        return importlib.import_module('spider')
+    finally:
+        os.chdir(cwd)
+
+class IdTableTest(unittest.TestCase):
+    def test_add_discard(self):
+        table = IdTable()
+        self.assertTrue(table.add(7))
+        self.assertFalse(table.add(7))
+        self.assertIn(7, table)
+        table.discard(7)
+        table.discard(7)
+        self.assertNotIn(7, table)
+        self.assertEqual(len(table), 0)
+
+    def test_grows_and_shrinks(self):
+        table = IdTable()
+        ids = range(900000000, 900000000 + 5000)
+        for match_id in ids:
+            table.add(match_id)
+        self.assertEqual(sorted(table), list(ids))
+        # At most half full after a rebuild, at most two thirds before the next.
+        self.assertLessEqual(table.nbytes(), 8*3*len(ids))
+        for match_id in ids[:4990]:
+            table.discard(match_id)
+        self.assertEqual(sorted(table), list(ids[4990:]))
+        self.assertLess(table.nbytes(), 8*8*10)
+
+class MatchBacklogTest(unittest.TestCase):
+    def test_wrap_around_then_grow_keeps_order(self):
+        match_ids = MatchBacklog()
+        capacity = MatchBacklog._INITIAL_CAPACITY
+        match_ids.put(range(capacity))
+        # Move the head, so the ring wraps when refilled.
+        self.assertEqual(match_ids.get_batch(10), [str(i) for i in range(10)])
+        match_ids.put(range(capacity, capacity + 10))
+        self.assertEqual(len(match_ids._buf), capacity)
+        # Full, so the next put grows the buffer.
+        match_ids.put([capacity + 10])
+        self.assertEqual(len(match_ids._buf), 2*capacity)
+        expected = [str(i) for i in range(10, capacity + 11)]
+        self.assertEqual(match_ids.get_batch(2*capacity), expected)
+
+    def test_rejects_queued_and_in_flight(self):
+        match_ids = MatchBacklog()
+        self.assertEqual(match_ids.put(["1", "2", "2"]), 2)
+        self.assertEqual(match_ids.get_batch(1), ["1"])
+        self.assertEqual(match_ids.put(["1", "2", "3"]), 1)
+        self.assertIn("1", match_ids)
+        self.assertEqual(match_ids.in_flight(), 1)
+        match_ids.done(["1"])
+        self.assertNotIn("1", match_ids)
+        self.assertEqual(match_ids.put(["1"]), 1)
+
+    def test_put_back_drops_after_max_fails(self):
+        match_ids = MatchBacklog(["1", "2"])
+        for _ in range(MatchBacklog._MAX_FAILS - 1):
+            batch = match_ids.get_batch(2)
+            self.assertEqual(match_ids.put_back(batch, failed=True), [])
+        batch = match_ids.get_batch(2)
+        # Not charged a failure, so it is put back again.
+        self.assertEqual(match_ids.put_back(["2"]), [])
+        self.assertEqual(match_ids.put_back(["1"], failed=True), ["1"])
+        self.assertEqual(match_ids.get_batch(2), ["2"])
+        self.assertEqual(match_ids.in_flight(), 1)
+
+    def test_pickle_keeps_in_flight(self):
+        match_ids = MatchBacklog(["1", "2", "3"])
+        match_ids.get_batch(1)
+        restored = pickle.loads(pickle.dumps(match_ids))
+        self.assertEqual(restored.get_batch(3), ["2", "3", "1"])
+        self.assertEqual(restored.in_flight(), 3)
+
+class OverwatchLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.spider = import_spider(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_loads_legacy_deque(self):
+        overwatcher = self.spider.Overwatch()
+        for attr in dir(overwatcher):
+            if attr.endswith('_FILE'):
+                setattr(overwatcher, attr, os.path.join(self.folder.name, attr.lower()))
+        with open(overwatcher._COMPLETED_MATCH_FINAL_FILE, 'wb') as fp:
+            pickle.dump(collections.deque(["1", "2", "1"]), fp)
+        overwatcher.load()
+        self.assertIsInstance(overwatcher.match_ids, backlog.MatchBacklog)
+        self.assertEqual(overwatcher.get_matches(3), ["1", "2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import time
+import unittest
+import urllib.error
+
+import retry
+from paladins import RequestLimitException
+
+def raise_(e):
+    def fn():
+        raise e
+    return fn
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = retry.RetryPolicy(
+            max_attempts=1,
+            backoff=retry.Backoff(base=0),
+            threshold=2,
+            reset_timeout=0.05)
+        self.breaker = self.policy.breaker("x")
+
+    def open_circuit(self):
+        for _ in range(2):
+            with self.assertRaises(urllib.error.URLError):
+                self.policy.call("x", raise_(urllib.error.URLError("down")))
+
+    def half_open(self):
+        self.open_circuit()
+        with self.assertRaises(retry.CircuitOpenException):
+            self.policy.call("x", lambda: "ok")
+        time.sleep(0.06)
+
+    def test_closed(self):
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+        with self.assertRaises(urllib.error.URLError):
+            self.policy.call("x", raise_(urllib.error.URLError("down")))
+        # One failure is below the threshold.
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+
+    def test_opens_after_threshold(self):
+        self.open_circuit()
+        with self.assertRaises(retry.CircuitOpenException):
+            self.policy.call("x", lambda: "ok")
+
+    def test_half_open_success_closes(self):
+        self.half_open()
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+
+    def test_half_open_allows_single_trial(self):
+        self.half_open()
+        self.breaker.allow()
+        with self.assertRaises(retry.CircuitOpenException):
+            self.breaker.allow()
+
+    def test_half_open_failure_reopens(self):
+        self.half_open()
+        with self.assertRaises(urllib.error.URLError):
+            self.policy.call("x", raise_(urllib.error.URLError("down")))
+        with self.assertRaises(retry.CircuitOpenException):
+            self.policy.call("x", lambda: "ok")
+        time.sleep(0.06)
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+
+    def test_half_open_quota_reopens(self):
+        self.half_open()
+        with self.assertRaises(RequestLimitException):
+            self.policy.call("x", raise_(RequestLimitException()))
+        with self.assertRaises(retry.CircuitOpenException):
+            self.policy.call("x", lambda: "ok")
+        # The circuit must not be stuck open after a quota error.
+        time.sleep(0.06)
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+
+    def test_quota_does_not_count_as_failure(self):
+        for _ in range(3):
+            with self.assertRaises(RequestLimitException):
+                self.policy.call("x", raise_(RequestLimitException()))
+        self.assertEqual(self.policy.call("x", lambda: "ok"), "ok")
+
+class ClassifyTest(unittest.TestCase):
+    def test_kinds(self):
+        self.assertEqual(retry.classify(RequestLimitException()), retry.ErrorKind.quota)
+        self.assertEqual(retry.classify(urllib.error.HTTPError("u", 429, "", None, None)), retry.ErrorKind.quota)
+        self.assertEqual(retry.classify(urllib.error.HTTPError("u", 503, "", None, None)), retry.ErrorKind.transient)
+        self.assertEqual(retry.classify(urllib.error.HTTPError("u", 404, "", None, None)), retry.ErrorKind.permanent)
+        self.assertEqual(retry.classify(urllib.error.URLError("down")), retry.ErrorKind.transient)
+        self.assertEqual(retry.classify(KeyError("Match")), retry.ErrorKind.permanent)
+
+if __name__ == "__main__":
+    unittest.main()